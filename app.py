@@ -1,9 +1,25 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import xlsxwriter
 import os
 import io
+import hashlib
+import re
 import zipfile
+import tempfile
 import time
+import datetime
+from collections import deque
+from functools import partial
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+
+# numba 为可选依赖：安装了就用编译后的单趟划分，否则退回到 numpy 排序实现
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 # --- 页面基础设置 ---
 st.set_page_config(
@@ -12,64 +28,264 @@ st.set_page_config(
     layout="wide"
 )
 
+# --- 读取缓存：按文件内容缓存解析结果，避免每次界面刷新都重新解析Excel ---
+# 缓存最多保留的文件数，避免服务长期运行时所有上传过的表格都常驻内存
+CACHE_MAX_ENTRIES = 4
+
+
+def _hash_file(file_bytes):
+    """计算上传文件内容的哈希值，作为读取缓存的键。"""
+    return hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
+
+
+# 缓存以文件内容的哈希作为键；参数名以下划线开头的文件内容不参与 Streamlit 的哈希计算，避免每次调用都把整个文件重新哈希一遍
+# 读取列名和拆分处理共用这一份缓存，同一个文件只解析一次
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def _load_excel(file_hash, _file_bytes, engine="calamine"):
+    """解析完整的Excel文件，返回DataFrame。默认使用基于Rust的calamine引擎，速度远快于openpyxl。"""
+    return pd.read_excel(io.BytesIO(_file_bytes), engine=engine)
+
+
+# --- 写出设置：直接用xlsxwriter逐行写出，并开启 constant_memory，每写完一行就落盘，内存占用不随行数增长 ---
+# 同时关闭对每个字符串的URL/公式自动识别，省去逐单元格的正则扫描；日期格式与 pandas 的 to_excel 保持一致
+XLSX_WORKBOOK_OPTIONS = {
+    'constant_memory': True,
+    'strings_to_urls': False,
+    'strings_to_formulas': False,
+    'default_date_format': 'yyyy-mm-dd hh:mm:ss',
+}
+# 时间和时长单元格如果沿用上面的日期格式，会显示成 "1900-01-00 08:30:00"，需要单独设置格式
+XLSX_TIME_FORMAT = 'hh:mm:ss'
+XLSX_DURATION_FORMAT = '[h]:mm:ss'
+# 表头样式与 pandas 的 to_excel 保持一致
+XLSX_HEADER_FORMAT = {'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'}
+
+# 文件名中只保留文字、数字、空格、下划线和连字符（预编译，整串一次扫描完成）
+_UNSAFE_FILENAME_CHARS = re.compile(r'[^\w \-]')
+
+# 逐个分组的日志刷新间隔（秒），避免分组很多时界面渲染拖慢处理速度
+LOG_RENDER_INTERVAL = 0.1
+# 处理过程中日志区域显示的最大行数，每次刷新的开销不再随分组数增长
+LOG_TAIL_LINES = 200
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _partition_codes(codes, n_groups):
+        """
+        按分组编码给行号做一次计数排序，返回 (各分组的起止位置, 按分组排好的行号)。
+        编码为 -1 的行（空白单元格）不属于任何分组，直接跳过。
+        """
+        counts = np.zeros(n_groups, np.int64)
+        for c in codes:
+            if c >= 0:
+                counts[c] += 1
+        bounds = np.zeros(n_groups + 1, np.int64)
+        bounds[1:] = counts.cumsum()
+        order = np.empty(bounds[-1], np.int64)
+        cursor = bounds[:-1].copy()
+        for i in range(codes.size):
+            c = codes[i]
+            if c >= 0:
+                order[cursor[c]] = i
+                cursor[c] += 1
+        return bounds, order
+else:
+    def _partition_codes(codes, n_groups):
+        """没有安装 numba 时的实现：稳定排序后用 searchsorted 找出各分组的起止位置，返回值与上面相同。"""
+        order = np.argsort(codes, kind='stable')
+        # 空白单元格的编码为 -1，排在最前面，不属于任何分组
+        order = order[np.count_nonzero(codes < 0):]
+        bounds = np.searchsorted(codes[order], np.arange(n_groups + 1))
+        return bounds, order
+
+
+def _split_groups(df, column_name):
+    """
+    按指定列把表格拆成若干分组，返回 (重排后的DataFrame, [(分组值, 起始行, 结束行), ...])，
+    分组顺序与该值首次出现的顺序一致。
+    先用 factorize 把列值编码成整数，再按编码对行号做一次划分，把整表重排成各分组首尾相接的形式，
+    之后每个分组只是重排后表格上的一段连续行，不需要再逐个分配筛选掩码或构造新的DataFrame。
+    """
+    codes, uniques = pd.factorize(df[column_name], sort=False)
+    if len(uniques) == 0:
+        return df, []
+    if len(uniques) == 1 and codes.min() >= 0:
+        # 所有行都属于同一个分组，原表本身就是结果，无需重排复制
+        return df, [(uniques[0], 0, len(df))]
+    bounds, order = _partition_codes(codes.astype(np.int64), len(uniques))
+    df_sorted = df.take(order)
+    return df_sorted, [
+        (value, int(bounds[i]), int(bounds[i + 1]))
+        for i, value in enumerate(uniques)
+    ]
+
+
+def _to_rows(df):
+    """把一个分组转换成Python对象的行列表，空值统一记为 None（xlsxwriter 会把它当作空白单元格跳过）。"""
+    columns = [
+        df[c].astype(object).where(df[c].notna(), None).tolist()
+        for c in df.columns
+    ]
+    return list(zip(*columns))
+
+
+def _column_formats(df):
+    """为每一列选择单元格格式：时间列和时长列返回对应的格式字符串，其余列返回 None（使用默认格式）。"""
+    column_formats = []
+    for c in df.columns:
+        column = df[c]
+        num_format = None
+        if column.dtype.kind == 'm':
+            num_format = XLSX_DURATION_FORMAT
+        elif column.dtype == object:
+            value_types = set(map(type, column.dropna()))
+            if any(issubclass(t, datetime.time) for t in value_types):
+                num_format = XLSX_TIME_FORMAT
+            elif any(issubclass(t, datetime.timedelta) for t in value_types):
+                num_format = XLSX_DURATION_FORMAT
+        column_formats.append(num_format)
+    return column_formats
+
+
+def _write_xlsx(header, rows, column_formats):
+    """用xlsxwriter把表头和若干行数据写成一个xlsx文件，返回文件内容。column_formats 为每列的格式字符串（或 None）。"""
+    excel_buffer = io.BytesIO()
+    workbook = xlsxwriter.Workbook(excel_buffer, XLSX_WORKBOOK_OPTIONS)
+    worksheet = workbook.add_worksheet('Sheet1')
+    worksheet.write_row(0, 0, header, workbook.add_format(XLSX_HEADER_FORMAT))
+    cell_formats = [
+        workbook.add_format({'num_format': num_format}) if num_format else None
+        for num_format in column_formats
+    ]
+    if not any(cell_formats):
+        for row_index, row in enumerate(rows, 1):
+            worksheet.write_row(row_index, 0, row)
+    else:
+        for row_index, row in enumerate(rows, 1):
+            for col_index, value in enumerate(row):
+                if value is not None:
+                    worksheet.write(row_index, col_index, value, cell_formats[col_index])
+    workbook.close()
+    return excel_buffer.getvalue()
+
+
+def _serialize_group(df_sorted, fast_mode, task):
+    """
+    在工作线程中把一个分组写成Excel（或快速模式下的CSV）文件，返回 (文件名, 行数, 文件内容)。
+    行数据在工作线程中按分组转换，同一时间内存里只有正在处理的少量分组的Python对象。
+    """
+    output_filename_in_zip, start, stop = task
+    df_group = df_sorted.iloc[start:stop]
+    if fast_mode:
+        # 带BOM的UTF-8，保证用Excel直接打开时中文不乱码
+        data = df_group.to_csv(index=False).encode('utf-8-sig')
+    else:
+        data = _write_xlsx(df_sorted.columns.tolist(), _to_rows(df_group), _column_formats(df_group))
+    return output_filename_in_zip, stop - start, data
+
+
 # --- 主函数，现在接收一个streamlit占位符来显示日志 ---
-def process_and_zip(uploaded_file, column_name, log_container):
+def process_and_zip(uploaded_file, file_bytes, file_hash, column_name, log_container, fast_mode=False):
     """
     处理上传的Excel文件，将其拆分，并将结果打包成一个ZIP文件。
+    file_bytes 为上传文件的内容，file_hash 为其哈希值，作为读取缓存的键；读取列名时已经解析过的文件在这里直接命中缓存。
     同时，将处理日志实时更新到指定的Streamlit容器中。
+    fast_mode=True 时每个分组输出为CSV文件，生成速度比xlsx快得多。
     """
-    logs = []  # 用来收集日志信息
+    logs = []  # 用来收集完整的日志信息
+    recent_logs = deque(maxlen=LOG_TAIL_LINES)  # 处理过程中只显示最近的若干行
+    last_render = 0.0  # 上一次刷新界面的时间
 
-    def log_message(message):
-        """辅助函数，用于记录日志并更新界面"""
-        logs.append(message)
+    def render(lines):
         # 使用Markdown的代码块格式来显示日志
-        log_container.markdown("```\n" + "\n".join(logs) + "\n```")
+        log_container.markdown("```\n" + "\n".join(lines) + "\n```")
+
+    def log_message(message, throttle=False):
+        """辅助函数，用于记录日志并更新界面；throttle=True 时每 0.1 秒最多刷新一次界面"""
+        nonlocal last_render
+        logs.append(message)
+        recent_logs.append(message)
+        now = time.monotonic()
+        if throttle and now - last_render < LOG_RENDER_INTERVAL:
+            return
+        last_render = now
+        render(recent_logs)
+
+    zip_path = None  # 结果ZIP所在的临时文件路径
+    completed = False  # 是否成功生成了完整的结果ZIP
 
     try:
         # 获取源文件名（不含扩展名），用于日志和输出文件名
         source_filename = os.path.splitext(uploaded_file.name)[0]
         
         log_message(f"准备处理文件: {uploaded_file.name}")
-        df = pd.read_excel(uploaded_file)
+        df = _load_excel(file_hash, file_bytes)
         
         total_rows = len(df)
         log_message(f"✅ 成功读取源文件，共包含 {total_rows} 条数据。")
 
-        unique_values = df[column_name].dropna().unique()
-        log_message(f"🔍 在“{column_name}”列中发现 {len(unique_values)} 个独立的收货单位，准备开始拆分...")
+        # 一次分组，代替对每个值做一遍整表布尔筛选（空白单元格会被自动排除）
+        df_sorted, grouped = _split_groups(df, column_name)
+        num_groups = len(grouped)
+        log_message(f"🔍 在“{column_name}”列中发现 {num_groups} 个独立的收货单位，准备开始拆分...")
         log_message("-" * 40) # 分割线
 
-        # 创建一个在内存中的ZIP文件
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
-            original_columns = df.columns.tolist()
-            
+        if num_groups == 0:
+            log_message(f"⚠️ “{column_name}”列中没有任何数据，无需拆分。")
+            render(logs)
+            return None, None
+
+        # 把ZIP文件直接写到磁盘上的临时文件，而不是整包放在内存里
+        # xlsx 本身已经是压缩过的ZIP包，再次压缩几乎不会变小，所以默认直接存储（ZIP_STORED）；
+        # 快速模式输出的CSV是未压缩的文本，用最低级别的 DEFLATE 压缩，几乎不耗时就能明显减小体积
+        with tempfile.NamedTemporaryFile(suffix='.zip', delete=False) as zip_file:
+            zip_path = zip_file.name
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zf:
             processed_rows_count = 0
             
-            for i, value in enumerate(unique_values, 1):
-                df_group = df[df[column_name] == value]
-                num_rows_in_group = len(df_group)
-                processed_rows_count += num_rows_in_group
-                
+            # 重排后的表格保持原表的列顺序，无需再逐个分组 reindex
+            # 先整理好每个分组的输出文件名，序列化交给线程池并行完成
+            tasks = []
+            output_extension = '.csv' if fast_mode else '.xlsx'
+            for i, (value, start, stop) in enumerate(grouped, 1):
                 # 清理文件名
-                safe_filename = "".join([c for c in str(value) if c.isalnum() or c in (' ', '_', '-')]).rstrip()
+                safe_filename = _UNSAFE_FILENAME_CHARS.sub('', str(value)).rstrip()
                 if not safe_filename:
                     safe_filename = f"未命名项目_{i}"
                 
-                output_filename_in_zip = f"{safe_filename}.xlsx"
-                
-                # 将拆分出的Excel文件写入内存
-                excel_buffer = io.BytesIO()
-                df_group.reindex(columns=original_columns).to_excel(excel_buffer, index=False, engine='openpyxl')
-                excel_buffer.seek(0)
-                
-                # 将内存中的Excel文件添加到ZIP包中
-                zf.writestr(output_filename_in_zip, excel_buffer.read())
+                output_filename_in_zip = f"{safe_filename}{output_extension}"
+                tasks.append((output_filename_in_zip, start, stop))
+            
+            # 各分组按行号区间从重排后的表格中取出，交给工作线程写出
+            serialize = partial(_serialize_group, df_sorted, fast_mode)
+            
+            # ZipFile 不是线程安全的，所以只并行生成Excel，写入ZIP仍在主线程中按顺序进行
+            # 同时最多只保留少量已提交的分组，避免所有生成好的Excel内容同时堆积在内存里
+            max_workers = os.cpu_count() or 1
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                pending = deque()
+                task_iter = iter(tasks)
+                for task in islice(task_iter, max_workers * 2):
+                    pending.append(executor.submit(serialize, task))
                 
-                # 记录这条处理日志
-                log_message(f"({i}/{len(unique_values)}) 已生成文件: {output_filename_in_zip} (包含 {num_rows_in_group} 条数据)")
-                time.sleep(0.01) # 短暂休眠，让前端有时间渲染，看起来更流畅
+                i = 0
+                while pending:
+                    output_filename_in_zip, num_rows_in_group, excel_bytes = pending.popleft().result()
+                    task = next(task_iter, None)
+                    if task is not None:
+                        pending.append(executor.submit(serialize, task))
+                    i += 1
+                    processed_rows_count += num_rows_in_group
+                    
+                    # 将内存中的Excel文件添加到ZIP包中
+                    if fast_mode:
+                        zf.writestr(output_filename_in_zip, excel_bytes, compress_type=zipfile.ZIP_DEFLATED, compresslevel=1)
+                    else:
+                        zf.writestr(output_filename_in_zip, excel_bytes)
+                    
+                    # 记录这条处理日志
+                    log_message(f"({i}/{num_groups}) 已生成文件: {output_filename_in_zip} (包含 {num_rows_in_group} 条数据)", throttle=True)
 
         log_message("-" * 40)
         log_message("✅ 所有表格拆分完成！")
@@ -82,15 +298,23 @@ def process_and_zip(uploaded_file, column_name, log_container):
             log_message(f"⚠️ 警告：数据核对不匹配！有 {unprocessed_rows} 条数据未被处理。")
             log_message(f"   (原因通常是 '{column_name}' 列中存在空白单元格)")
         
-        # 将ZIP文件的指针也重置到开头
-        zip_buffer.seek(0)
-        return zip_buffer, source_filename
+        # 处理结束后一次性显示完整日志
+        render(logs)
+        
+        completed = True
+        return zip_path, source_filename
 
     except Exception as e:
         log_message(f"❌ 处理过程中发生错误: {e}")
         log_message("   请检查上传的文件格式是否正确，以及指定的列名是否存在于文件中。")
+        render(logs)
         return None, None
 
+    finally:
+        # 没有成功完成时清理已经生成的临时文件；Streamlit 停止或重新运行脚本时抛出的异常不属于 Exception，也要在这里处理
+        if not completed and zip_path is not None and os.path.exists(zip_path):
+            os.remove(zip_path)
+
 
 # --- Streamlit 界面布局 ---
 
@@ -104,14 +328,19 @@ uploaded_file = st.file_uploader("上传您的 Excel 总表", type=['xlsx'])
 if uploaded_file is not None:
     st.subheader("1. 设置拆分规则")
     
+    # 上传文件只计算一次哈希，作为读取缓存的键；列名直接取自完整读取的结果，点击拆分时命中同一份缓存
+    file_bytes = uploaded_file.getvalue()
+    file_hash = _hash_file(file_bytes)
+    
     try:
-        temp_df = pd.read_excel(uploaded_file, nrows=0)
-        column_options = temp_df.columns.tolist()
+        column_options = _load_excel(file_hash, file_bytes).columns.tolist()
         default_index = column_options.index('收货单位名称') if '收货单位名称' in column_options else 0
         column_to_split = st.selectbox("请选择用于分类的列名:", options=column_options, index=default_index)
     except Exception:
         column_to_split = st.text_input("无法自动读取列名，请输入用于分类的列名:", value="收货单位名称")
 
+    fast_mode = st.checkbox("快速模式（输出CSV文件）", help="数据量很大时，CSV的生成速度比Excel快很多，可以直接用Excel打开。")
+
     st.subheader("2. 开始处理并查看日志")
     
     # 创建一个用于显示日志的占位符
@@ -122,20 +351,28 @@ if uploaded_file is not None:
         # 在点击按钮后，清空占位符，准备显示新日志
         log_container.empty()
         
-        with st.spinner('正在处理中，请耐心等待...'):
-            zip_buffer, source_filename = process_and_zip(uploaded_file, column_to_split, log_container)
-        
-        if zip_buffer and source_filename:
-            st.success("🎉 处理完成！可以下载结果了。")
+        zip_path = None
+        try:
+            with st.spinner('正在处理中，请耐心等待...'):
+                zip_path, source_filename = process_and_zip(uploaded_file, file_bytes, file_hash, column_to_split, log_container, fast_mode=fast_mode)
             
-            st.subheader("3. 下载结果")
-            st.download_button(
-                label="📥 下载拆分结果 (ZIP)",
-                data=zip_buffer,
-                file_name=f'{source_filename}_拆分结果.zip',
-                mime='application/zip',
-                use_container_width=True
-            )
+            if zip_path and source_filename:
+                st.success("🎉 处理完成！可以下载结果了。")
+                
+                st.subheader("3. 下载结果")
+                # 直接把临时文件交给下载按钮
+                with open(zip_path, 'rb') as zip_file:
+                    st.download_button(
+                        label="📥 下载拆分结果 (ZIP)",
+                        data=zip_file,
+                        file_name=f'{source_filename}_拆分结果.zip',
+                        mime='application/zip',
+                        use_container_width=True
+                    )
+        finally:
+            # 交付后（或脚本被中断时）删除临时文件
+            if zip_path is not None and os.path.exists(zip_path):
+                os.remove(zip_path)
 else:
     st.info("请上传一个 .xlsx 文件以开始。")
 